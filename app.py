@@ -1,22 +1,206 @@
 import streamlit as st
 import pandas as pd
 import io
-import json  # NEW: for JSON export
-from presidio_analyzer import AnalyzerEngine
-from presidio_anonymizer import AnonymizerEngine
-from presidio_anonymizer.entities import OperatorConfig
+import os
+import re
+import numpy as np
+import orjson
+import spacy
+import xlsxwriter
+from presidio_analyzer import AnalyzerEngine, RecognizerResult
 from presidio_analyzer.nlp_engine import NlpEngineProvider
 
 # --- Presidio NLP setup ---
-nlp_configuration = {
-    "nlp_engine_name": "spacy",
-    "models": [{"lang_code": "en", "model_name": "en_core_web_sm"}]  # use _sm on Streamlit for speed
+# Cached per process so Streamlit reruns (widget changes, uploads) don't reload the spaCy model
+@st.cache_resource
+def get_analyzer(model_name: str):
+    nlp_configuration = {
+        "nlp_engine_name": "spacy",
+        "models": [{"lang_code": "en", "model_name": model_name}]
+    }
+    provider = NlpEngineProvider(nlp_configuration=nlp_configuration)
+    nlp_engine = provider.create_engine()
+    # Presidio never reads the dependency parse, and the parser is the slowest pipeline stage.
+    # tagger/attribute_ruler/lemmatizer stay on: their lemmas drive Presidio's context-word scoring.
+    nlp = nlp_engine.nlp["en"]
+    if "parser" in nlp.pipe_names:
+        nlp.disable_pipe("parser")
+    return AnalyzerEngine(nlp_engine=nlp_engine, supported_languages=["en"])
+
+
+def fast_replace(text: str, results, new_value: str) -> str:
+    """Replace every result span in `text` with `new_value`, in a single pass over the text.
+
+    Overlapping spans get one replacement. Neighbouring spans are not merged here:
+    detect_rows already did that (merge_adjacent_results), so the preview matches the exports.
+    """
+    out = []
+    pos = 0
+    for r in sorted(results, key=lambda r: r.start):
+        if r.start < pos:
+            pos = max(pos, r.end)
+            continue
+        out.append(text[pos:r.start])
+        out.append(new_value)
+        pos = r.end
+    out.append(text[pos:])
+    return "".join(out)
+
+
+# Minimum confidence for a detection to be redacted
+SCORE_THRESHOLD = 0.85
+
+# Long .txt transcripts are split on blank lines for NER (LF or CRLF, blank lines may hold spaces/tabs)
+PARAGRAPH_BREAK_RE = re.compile(r"\r?\n[ \t]*\r?\n")
+
+# Worker processes for NER only pay off once there are enough rows to spread out
+MULTIPROCESS_MIN_ROWS = 100
+
+# Cached uploads and detections hold transcript text and PII spans and are shared across sessions,
+# so keep only a few recent ones and let them expire
+CACHE_MAX_ENTRIES = 8
+CACHE_TTL = "1h"
+
+# Location terms that are never redacted (matched case-insensitively against the whole entity)
+EXCLUDE_WORDS = {
+    "america", "united states", "us", "usa", "u.s.",
+    "the united states", "the us", "the usa", "the u. s."
+}
+EXCLUDE_RE = re.compile("|".join(re.escape(w) for w in sorted(EXCLUDE_WORDS)), re.IGNORECASE)
+
+
+def merge_adjacent_results(text: str, results):
+    """Merge same-type results that overlap or are separated by at most one whitespace character.
+
+    e.g. separate PERSON hits for "John" and "Smith" become one "John Smith" result.
+    """
+    merged = []
+    for r in sorted(results, key=lambda r: r.start):
+        prev = merged[-1] if merged else None
+        if (prev is not None and r.entity_type == prev.entity_type
+                and r.start - prev.end <= 1 and not text[prev.end:r.start].strip()):
+            merged[-1] = RecognizerResult(
+                entity_type=prev.entity_type,
+                start=prev.start,
+                end=max(prev.end, r.end),
+                score=max(prev.score, r.score),
+                analysis_explanation=prev.analysis_explanation,
+                recognition_metadata=prev.recognition_metadata
+            )
+        else:
+            merged.append(r)
+    return merged
+
+
+def detect_rows(analyzer, row_texts, entities: tuple, score_threshold: float, batch_size=64, n_process=1):
+    """Detect entities in each row, leaving out excluded location terms; returns one merged result list per row."""
+    # Rows that are nothing but an excluded location term ("USA", "America") have nothing to redact,
+    # so only the remaining rows go through NER
+    row_is_excluded = pd.Series(row_texts).str.strip().str.lower().isin(EXCLUDE_WORDS)
+    rows_to_analyze = row_is_excluded.index[~row_is_excluded].tolist()
+
+    # Parse all rows in one batched spaCy pass, then run Presidio's recognizers on each parsed row
+    row_results = [[] for _ in row_texts]
+    row_artifacts = analyzer.nlp_engine.process_batch(
+        [row_texts[row_pos] for row_pos in rows_to_analyze],
+        "en",
+        batch_size=batch_size,
+        n_process=n_process if len(rows_to_analyze) >= MULTIPROCESS_MIN_ROWS else 1
+    )
+    for row_pos, (row_text, row_nlp_artifacts) in zip(rows_to_analyze, row_artifacts):
+        # Analyze only the selected entities
+        raw_results = analyzer.analyze(
+            text=row_text,
+            language="en",
+            entities=list(entities),
+            score_threshold=score_threshold,
+            nlp_artifacts=row_nlp_artifacts
+        )
+        # Exclude certain location terms from redaction, then merge neighbouring spans of the same type
+        results = [r for r in raw_results if not EXCLUDE_RE.fullmatch(row_text, r.start, r.end)]
+        row_results[row_pos] = merge_adjacent_results(row_text, results)
+    return row_results
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL)
+def analyze_rows(row_texts, entities: tuple, score_threshold: float, model_name: str, _batch_size=64, _n_process=1):
+    """Cached wrapper around detect_rows for the selected model.
+
+    Cached on everything that affects detection, so changing only the replacement text
+    re-runs the redaction without re-running NER. The underscored spaCy throughput settings
+    don't change the results and are left out of the cache key.
+    """
+    return detect_rows(get_analyzer(model_name), row_texts, entities, score_threshold, _batch_size, _n_process)
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL)
+def read_xlsx(data: bytes) -> pd.DataFrame:
+    """Read the first sheet of an uploaded .xlsx; cached so reruns don't re-parse the workbook."""
+    return pd.read_excel(io.BytesIO(data))
+
+
+def write_xlsx(df: pd.DataFrame) -> io.BytesIO:
+    """Write a DataFrame to an in-memory .xlsx using xlsxwriter's constant_memory mode.
+
+    constant_memory flushes each row as soon as a later row is started, so rows have to be
+    written strictly in order; DataFrame.to_excel writes column by column, which would drop cells.
+    """
+    output = io.BytesIO()
+    workbook = xlsxwriter.Workbook(output, {
+        "constant_memory": True,
+        "strings_to_urls": False,  # keep transcript text as plain text, like openpyxl did
+        "nan_inf_to_errors": True,
+        "default_date_format": "yyyy-mm-dd hh:mm:ss",
+    })
+    worksheet = workbook.add_worksheet()
+    # Same header style as DataFrame.to_excel
+    header_format = workbook.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    worksheet.write_row(0, 0, list(df.columns), header_format)
+    values = df.astype(object).where(df.notna(), None)
+    for row_num, row in enumerate(values.itertuples(index=False), start=1):
+        worksheet.write_row(row_num, 0, row)
+    workbook.close()
+    output.seek(0)
+    return output
+
+
+# spaCy model for NER: _sm is the default on Streamlit for speed and memory; _lg is opt-in
+MODEL_OPTIONS = {
+    "sm (fast)": "en_core_web_sm",
+    "lg (accurate)": "en_core_web_lg",
 }
-provider = NlpEngineProvider(nlp_configuration=nlp_configuration)
-nlp_engine = provider.create_engine()
+model_choice = st.sidebar.radio(
+    "Model",
+    options=list(MODEL_OPTIONS),
+    help="The large model is slightly more accurate but much slower to load and uses far more memory. "
+         "It is downloaded the first time it is selected."
+)
+
+# Run spaCy on the GPU when there is one (needs CuPy), otherwise silently stay on CPU.
+# Must happen before the model is loaded; models keep the device they were loaded on.
+gpu_enabled = spacy.prefer_gpu()
+st.sidebar.caption("NER device: GPU" if gpu_enabled else "NER device: CPU")
+
+# spaCy throughput settings; worker processes don't mix with the GPU, so they're CPU-only
+use_multiprocessing = st.sidebar.checkbox(
+    "Use multiple CPU cores",
+    value=False,
+    disabled=gpu_enabled,
+    help=f"Runs NER in parallel worker processes. Only used for files with at least {MULTIPROCESS_MIN_ROWS} rows, "
+         "where it outweighs the cost of starting the processes. Not available when running on a GPU."
+)
+batch_size = st.sidebar.slider(
+    "spaCy batch size",
+    min_value=8,
+    max_value=256,
+    value=64,
+    step=8,
+    help="Number of rows spaCy processes together."
+)
+
+model_name = MODEL_OPTIONS[model_choice]
+get_analyzer(model_name)  # load the model up front rather than after the upload
 
-analyzer = AnalyzerEngine(nlp_engine=nlp_engine, supported_languages=["en"])
-anonymizer = AnonymizerEngine()
 
 # --- Streamlit UI ---
 st.title("Transcript Anonymizer")
@@ -34,6 +218,7 @@ ENTITY_OPTIONS = [
     "IP_ADDRESS", "URL", "CREDIT_CARD", "US_SSN", "IBAN_CODE", "SWIFT_CODE",
     "ORGANIZATION"
 ]
+
 selected_entities = st.multiselect(
     "Choose entity types to redact",
     options=ENTITY_OPTIONS,
@@ -48,16 +233,21 @@ file_type = None
 df = None
 column_choice = None
 orig_index_nonnull = None  # to re-align redactions back into the Excel rows
+row_texts = None  # analyzed independently: the whole transcript for .txt, one entry per non-null row for .xlsx
 
 # --- Read file content ---
 if uploaded_file is not None:
     if uploaded_file.name.endswith(".txt"):
         file_type = "txt"
+        # The upload is a BytesIO, and reading all of it hands back its buffer without copying,
+        # so decoding the result is already a single pass with no extra copy of the raw bytes
         text = uploaded_file.read().decode("utf-8")
+        if text:
+            row_texts = [text]
 
     elif uploaded_file.name.endswith(".xlsx"):
         file_type = "xlsx"
-        df = pd.read_excel(uploaded_file)
+        df = read_xlsx(uploaded_file.getvalue())
 
         # Default to "text" column if present, otherwise first column
         default_index = 0
@@ -70,44 +260,108 @@ if uploaded_file is not None:
             # Keep track of which rows are non-null so we can put redactions back in-place
             mask = df[column_choice].notna()
             orig_index_nonnull = df.index[mask]
-            # Combine only non-null rows for analysis (preserves row count when we split later)
-            text = "\n".join(df.loc[orig_index_nonnull, column_choice].astype(str))
+            row_texts = df.loc[orig_index_nonnull, column_choice].astype(str).tolist()
 
 # --- Process redaction ---
-if text and selected_entities:
-    # Analyze only the selected entities
-    raw_results = analyzer.analyze(
-        text=text,
-        language="en",
-        entities=selected_entities,
-        score_threshold=0.85
-    )
+if row_texts and selected_entities:
+    # A .txt transcript is analyzed paragraph by paragraph so spaCy can batch the paragraphs
+    # instead of building one huge Doc; Excel rows are analyzed as they are
+    if file_type == "txt":
+        paragraph_starts = [0]
+        analysis_texts = []
+        for m in PARAGRAPH_BREAK_RE.finditer(text):
+            analysis_texts.append(text[paragraph_starts[-1]:m.start()])
+            paragraph_starts.append(m.end())
+        analysis_texts.append(text[paragraph_starts[-1]:])
+    else:
+        analysis_texts = row_texts
+    with st.spinner("Detecting entities..."):
+        analysis_results = analyze_rows(
+            analysis_texts,
+            tuple(sorted(selected_entities)),
+            SCORE_THRESHOLD,
+            model_name,
+            _batch_size=batch_size,
+            _n_process=max(1, (os.cpu_count() or 1) - 1) if use_multiprocessing and not gpu_enabled else 1
+        )
 
-    # Exclude certain location terms from redaction
-    EXCLUDE_WORDS = {
-        "america", "united states", "us", "usa", "u.s.",
-        "the united states", "the us", "the usa", "the u. s."
-    }
+    if file_type == "txt":
+        # Shift paragraph offsets back onto the whole transcript (analyze_rows hands back fresh copies)
+        transcript_results = []
+        for paragraph_start, results in zip(paragraph_starts, analysis_results):
+            for r in results:
+                r.start += paragraph_start
+                r.end += paragraph_start
+                transcript_results.append(r)
+        row_results = [transcript_results]
+    else:
+        row_results = analysis_results
+
+    # --- Label Studio tasks ---
+    def _presidio_to_ls_results(text_segment: str, seg_results):
+        """Convert a segment's analyzer results to LS-style prediction results."""
+        return [{
+            "from_name": "pii",     # must match <Labels name="pii"> in LS config
+            "to_name": "text",      # must match <Text name="text">
+            "type": "labels",
+            "value": {
+                "start": int(rr.start),
+                "end": int(rr.end),
+                "text": text_segment[rr.start:rr.end],
+                "labels": [str(rr.entity_type)]
+            },
+            "score": float(getattr(rr, "score", 0)) if getattr(rr, "score", None) is not None else None
+        } for rr in seg_results]
 
-    results = []
-    for r in raw_results:
-        entity_text = text[r.start:r.end].lower()
-        if entity_text in EXCLUDE_WORDS:
-            continue
-        results.append(r)
+    ls_tasks = []
+
+    if file_type == "xlsx" and df is not None and column_choice:
+        # One LS task per non-null row in the chosen column
+        for ridx, row_text, results in zip(orig_index_nonnull, row_texts, row_results):
+            if not row_text.strip():
+                continue
+            ls_tasks.append({
+                "data": {
+                    "text": row_text,
+                    "source_file": getattr(uploaded_file, "name", "uploaded.xlsx"),
+                    "sheet_column": column_choice,
+                    "row_index": int(ridx)
+                },
+                "predictions": [{
+                    "model_version": "presidio-v1",
+                    "result": _presidio_to_ls_results(row_text, results)
+                }]
+            })
+    else:
+        # TXT (or fallback): single task with the full text
+        ls_tasks.append({
+            "data": {"text": text},
+            "predictions": [{
+                "model_version": "presidio-v1",
+                "result": _presidio_to_ls_results(text, row_results[0])
+            }]
+        })
 
     # --- Exportable analysis results (JSON/CSV) ---
-    export_data = [r.to_dict() for r in results]
-    df_results = pd.DataFrame(export_data)
-
-    # Redact with user-selected replacement
-    redacted = anonymizer.anonymize(
-        text=text,
-        analyzer_results=results,
-        operators={
-            "DEFAULT": OperatorConfig("replace", {"new_value": redaction_text})
-        }
-    ).text
+    # Built column by column instead of as a list of per-result dicts
+    all_results = [r for results in row_results for r in results]
+    n_results = len(all_results)
+    export_columns = {
+        "entity_type": [r.entity_type for r in all_results],
+        "start": np.fromiter((r.start for r in all_results), dtype=np.int32, count=n_results),
+        "end": np.fromiter((r.end for r in all_results), dtype=np.int32, count=n_results),
+        "score": np.fromiter((r.score for r in all_results), dtype=np.float64, count=n_results),
+        "analysis_explanation": [r.analysis_explanation for r in all_results],
+        "recognition_metadata": [r.recognition_metadata for r in all_results],
+    }
+    if file_type == "xlsx":
+        # Offsets are relative to each row for Excel, so tag every result with its source row
+        export_columns["row_index"] = np.repeat(orig_index_nonnull.to_numpy(), [len(results) for results in row_results])
+    df_results = pd.DataFrame(export_columns)
+
+    # Redact each row with user-selected replacement
+    redacted_rows = [fast_replace(row_text, results, redaction_text) for row_text, results in zip(row_texts, row_results)]
+    redacted = "\n".join(redacted_rows)
 
     st.success("Redaction complete!")
 
@@ -121,7 +375,7 @@ if text and selected_entities:
     else:
         st.dataframe(df_results, use_container_width=True)
         csv_bytes = df_results.to_csv(index=False).encode("utf-8")
-        json_bytes = json.dumps(export_data, indent=2).encode("utf-8")
+        json_bytes = df_results.to_json(orient="records", indent=2).encode("utf-8")
 
         col1, col2 = st.columns(2)
         with col1:
@@ -152,21 +406,13 @@ if text and selected_entities:
         # Create a copy of the DataFrame to avoid modifying original
         df_redacted = df.copy()
 
-        # Split redacted text back to per-row values for the originally non-null rows
-        redacted_rows = redacted.split("\n")
-        if len(redacted_rows) != len(orig_index_nonnull):
-            st.warning("Row alignment mismatch after redaction; check for unexpected newlines in the source data.")
-
         # Initialize new column and assign redacted values only to rows that had text
         new_col = f"{column_choice}_REDACTED"
         df_redacted[new_col] = ""
-        df_redacted.loc[orig_index_nonnull, new_col] = redacted_rows[:len(orig_index_nonnull)]
+        df_redacted.loc[orig_index_nonnull, new_col] = redacted_rows
 
         # Save to BytesIO for download
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine="openpyxl") as writer:
-            df_redacted.to_excel(writer, index=False)
-        output.seek(0)
+        output = write_xlsx(df_redacted)
 
         st.download_button(
             label="⬇️ Download redacted .xlsx",
@@ -176,74 +422,7 @@ if text and selected_entities:
         )
 
     # --- NEW: Label Studio export (predictions) — ONE TASK PER ROW FOR EXCEL ---
-    def _presidio_to_ls_results(text_segment: str):
-        """Run analyzer on a segment and return LS-style prediction results."""
-        seg_raw = analyzer.analyze(
-            text=text_segment,
-            language="en",
-            entities=selected_entities,
-            score_threshold=0.85
-        )
-        seg_filtered = []
-        for rr in seg_raw:
-            seg_text = text_segment[rr.start:rr.end].lower()
-            if seg_text in EXCLUDE_WORDS:
-                continue
-            seg_filtered.append(rr)
-
-        ls_results_local = []
-        for rr in seg_filtered:
-            try:
-                snippet = text_segment[rr.start:rr.end]
-            except Exception:
-                snippet = ""
-            ls_results_local.append({
-                "from_name": "pii",     # must match <Labels name="pii"> in LS config
-                "to_name": "text",      # must match <Text name="text">
-                "type": "labels",
-                "value": {
-                    "start": int(rr.start),
-                    "end": int(rr.end),
-                    "text": snippet,
-                    "labels": [str(rr.entity_type)]
-                },
-                "score": float(getattr(rr, "score", 0)) if getattr(rr, "score", None) is not None else None
-            })
-        return ls_results_local
-
-    ls_tasks = []
-
-    if file_type == "xlsx" and df is not None and column_choice:
-        # One LS task per non-null row in the chosen column
-        nonnull_series = df.loc[orig_index_nonnull, column_choice].astype(str)
-        for ridx, row_text in nonnull_series.items():
-            if not row_text or not str(row_text).strip():
-                continue
-            ls_results_row = _presidio_to_ls_results(row_text)
-            ls_tasks.append({
-                "data": {
-                    "text": row_text,
-                    "source_file": getattr(uploaded_file, "name", "uploaded.xlsx"),
-                    "sheet_column": column_choice,
-                    "row_index": int(ridx)
-                },
-                "predictions": [{
-                    "model_version": "presidio-v1",
-                    "result": ls_results_row
-                }]
-            })
-    else:
-        # TXT (or fallback): single task with the full text
-        ls_results_full = _presidio_to_ls_results(text)
-        ls_tasks.append({
-            "data": {"text": text},
-            "predictions": [{
-                "model_version": "presidio-v1",
-                "result": ls_results_full
-            }]
-        })
-
-    ls_json_bytes = json.dumps(ls_tasks, ensure_ascii=False, indent=2).encode("utf-8")
+    ls_json_bytes = orjson.dumps(ls_tasks, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
     st.download_button(
         label="⬇️ Download Label Studio JSON (predictions)",
         data=ls_json_bytes,
@@ -252,5 +431,5 @@ if text and selected_entities:
         help="Import into Label Studio (Project → Import). For Excel, this creates one task per row."
     )
 
-elif text and not selected_entities:
+elif row_texts and not selected_entities:
     st.info("Select at least one entity type to redact.")